@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Measure latency and throughput of nagiosmailer for a number of scenarios: varying graph counts, dashboard page sizes,
+slow, failing and unreachable graph hosts, and concurrent invocations. Every notification is a new nagiosmailer process,
+just like when Nagios starts it, against a local graph server and a local sink mailserver (see servers.py).
+
+For every scenario and concurrency it reports the p50 and p99 end-to-end latency (from starting the process until it
+exits), the number of notifications per second, and the mean time per phase: importing nagiosmailer, parsing options
+and environment, scanning dashboards (parseWebpage), fetching images, building the MIME mail and sending it.
+
+usage: benchmarks/endtoend.py [--runs 20] [--concurrency 1,8] [--cache]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import servers
+
+NAGIOSMAILER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ICONS = os.path.join(NAGIOSMAILER, 'icons')
+
+BASEENV = {'NAGIOS_NOTIFICATIONTYPE': 'PROBLEM',
+           'NAGIOS_SERVICEDISPLAYNAME': 'check_load',
+           'NAGIOS_HOSTDISPLAYNAME': 'myhost.example.com',
+           'NAGIOS_HOSTADDRESS': '127.0.0.1',
+           'NAGIOS_SERVICESTATE': 'CRITICAL',
+           'NAGIOS_LONGDATETIME': 'Mon Oct 19 12:00:00 CEST 2026',
+           'NAGIOS_SERVICEOUTPUT': 'CRITICAL - load average: 30.00, 25.00, 20.00',
+           'NAGIOS_LASTSERVICEEVENTID': '1000',
+           'NAGIOS_CONTACTEMAIL': 'oncall@example.com'}
+
+PHASES = ['import', 'env', 'parseWebpage', 'fetch', 'mime', 'smtp']
+
+
+def scenarios(graphServer, deadServer):
+    """
+    :returns: a list of tuples (name, extra environment variables) for every scenario
+    :rtype: list
+    """
+    def graphs(count, size, server=graphServer, path='/graph', query=''):
+        return dict(('NAGIOS__SERVICEGRAPHURL%d' % num,
+                     '%s%s?size=%d__AMPERSAND__num=%d%s' % (server, path, size, num, query))
+                    for num in range(1, count + 1))
+
+    return [('text only', {}),
+            ('1 graph', graphs(1, 20000)),
+            ('6 graphs', graphs(6, 200000)),
+            ('dash 100kB', {'NAGIOS__SERVICEDASHURL1': '%s/dash?size=100000&anchor=g#g' % graphServer}),
+            ('dash 5MB first', {'NAGIOS__SERVICEDASHURL1': '%s/dash?size=5000000' % graphServer}),
+            ('dash 5MB anchor', {'NAGIOS__SERVICEDASHURL1': '%s/dash?size=5000000&anchor=g#g' % graphServer}),
+            ('slow graph', graphs(1, 20000, query='__AMPERSAND__delay=0.5')),
+            ('failing graph', graphs(2, 20000, path='/fail')),
+            ('unreachable', graphs(2, 20000, server=deadServer))]
+
+
+def deadAddress():
+    """
+    :returns: an URL prefix on localhost where nothing listens
+    :rtype: string
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'http://127.0.0.1:%d' % port
+
+
+def child(args):
+    """run a single notification in this process and print the time per phase as json"""
+    start = time.time()
+    sys.path.insert(0, NAGIOSMAILER)
+    import nagiosmailer
+    importTime = time.time() - start
+    sys.argv = ['nagiosmailer.py'] + args
+    nagiosmailer.main()
+    phases = dict(nagiosmailer.phaseTimes)
+    phases['import'] = importTime
+    print json.dumps(phases)
+
+
+def notification(env, args):
+    """start nagiosmailer in a new process
+
+    :returns: end-to-end latency (in seconds) and the time per phase
+    :rtype: float, dict
+    """
+    start = time.time()
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--child'] + args,
+                                     env=env)
+    return time.time() - start, json.loads(output.splitlines()[-1])
+
+
+def percentile(values, pct):
+    """nearest rank percentile of a sorted list"""
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure end-to-end latency and throughput of nagiosmailer")
+    parser.add_argument("--runs", type=int, default=20, help="notifications per scenario and concurrency (default: 20)")
+    parser.add_argument("--concurrency", default="1,8",
+                        help="comma separated numbers of concurrent notifications (default: 1,8)")
+    parser.add_argument("--cache", action="store_true",
+                        help="keep the graph cache enabled, by default every notification fetches its graphs")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    options, rest = parser.parse_known_args()
+    if options.child:
+        child(rest)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='nagiosmailer-bench')
+    smtpServer, httpServer = servers.start()
+    args = ['--configfile', os.path.join(workdir, 'none.conf'),
+            '--logFile', os.path.join(workdir, 'nagiosmailer.log'),
+            '--imgDirectory', ICONS,
+            '--timeout', '1',
+            '--smtpPort', str(smtpServer.socket.getsockname()[1])]
+    if not options.cache:
+        args += ['--cacheTtl', '0']
+
+    eventIds = iter(xrange(1001, sys.maxint))
+    eventLock = threading.Lock()
+
+    def run(extra):
+        env = dict(os.environ)
+        env.update(BASEENV)
+        env.update(extra)
+        with eventLock:
+            # a new event for every notification, so that no notification reuses a mail rendered by another one
+            env['NAGIOS_SERVICEEVENTID'] = str(eventIds.next())
+        return notification(env, args + ['--cacheDirectory', env['BENCH_CACHEDIRECTORY']])
+
+    print "%-16s %4s %4s %9s %9s %7s  %s" % ('scenario', 'conc', 'runs', 'p50', 'p99', 'notif/s',
+                                             '  '.join("%12s" % phase for phase in PHASES))
+    try:
+        for name, extra in scenarios('http://127.0.0.1:%d' % httpServer.server_port, deadAddress()):
+            for concurrency in [int(value) for value in options.concurrency.split(',')]:
+                # a fresh cache directory, so that no scenario starts with the cache or breaker state of another one
+                extra = dict(extra, BENCH_CACHEDIRECTORY=tempfile.mkdtemp(dir=workdir))
+                pool = ThreadPool(concurrency)
+                received = smtpServer.received
+                start = time.time()
+                results = pool.map(run, [extra] * options.runs)
+                elapsed = time.time() - start
+                pool.close()
+                latencies = sorted(latency for latency, phases in results)
+                means = ["%10.1fms" % (1000 * sum(phases.get(phase, 0) for latency, phases in results) / len(results))
+                         for phase in PHASES]
+                print "%-16s %4d %4d %7.1fms %7.1fms %7.1f  %s" % (name, concurrency, len(results),
+                                                                  1000 * percentile(latencies, 50),
+                                                                  1000 * percentile(latencies, 99),
+                                                                  len(results) / elapsed, '  '.join(means))
+                # give the sink mailserver a moment to process the last mail
+                time.sleep(0.2)
+                if smtpServer.received - received != len(results):
+                    print "  only %d of %d mails arrived" % (smtpServer.received - received, len(results))
+    finally:
+        servers.stop(smtpServer, httpServer)
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Local stand-ins for a graph server and a mailserver, so that the benchmarks never leave this host.
+
+The graph server knows these paths:
+  /graph?size=N&delay=S      : a PNG image of N bytes, sent after S seconds
+  /fail                      : a 500 error
+  /dash?size=N&anchor=A&img=M: a dashboard page of about N bytes. Without anchor the image (of M bytes) is the first
+                               thing on the page, with an anchor it comes last, after '<a name=A>'
+"""
+
+import asyncore
+import os
+import smtpd
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+ICON = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'icons', 'OK.png'), 'rb').read()
+
+
+class SinkServer(smtpd.SMTPServer):
+    """mailserver that counts and discards every mail"""
+
+    received = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+
+
+class GraphHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """serves graphs and dashboard pages of any size"""
+
+    # generated dashboard pages, so that generating them does not count in the benchmark
+    pages = {}
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path == '/graph':
+            time.sleep(float(query.get('delay', 0)))
+            size = int(query.get('size', len(ICON)))
+            self.reply('image/png', (ICON + '\0' * size)[:max(size, len(ICON))])
+        elif url.path == '/dash':
+            if url.query not in self.pages:
+                image = '<img src="/graph?size=%s">' % query.get('img', len(ICON))
+                filler = '<div class="graph"><p>some text around a graph</p></div>\n'
+                filler *= int(query.get('size', 10000)) / len(filler)
+                if 'anchor' in query:
+                    page = '<html><body>%s<a name="%s">%s</a></body></html>' % (filler, query['anchor'], image)
+                else:
+                    page = '<html><body>%s%s</body></html>' % (image, filler)
+                self.pages[url.query] = page
+            self.reply('text/html', self.pages[url.query])
+        else:
+            self.send_error(500)
+
+    def reply(self, contentType, body):
+        self.send_response(200)
+        self.send_header('content-type', contentType)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GraphServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # nagiosmailer stops reading a dashboard page once it has found the image, which breaks the connection
+        pass
+
+
+def start():
+    """start a sink mailserver and a graph server on free ports of localhost, in background threads
+
+    :returns: the mailserver and the graph server
+    :rtype: SinkServer, GraphServer
+    """
+    smtpServer = SinkServer(('127.0.0.1', 0), None)
+    smtpThread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+    smtpThread.daemon = True
+    smtpThread.start()
+    httpServer = GraphServer(('127.0.0.1', 0), GraphHandler)
+    httpThread = threading.Thread(target=httpServer.serve_forever)
+    httpThread.daemon = True
+    httpThread.start()
+    return smtpServer, httpServer
+
+
+def stop(smtpServer, httpServer):
+    """stop the servers started by start()"""
+    httpServer.shutdown()
+    smtpServer.close()
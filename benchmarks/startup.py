@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Measure how long a single nagiosmailer run takes, from starting the interpreter until the mail is handed over to the
+mailserver. Plain text notifications should not load the HTTP stack at all, so they are compared with notifications
+that have a graph. Everything runs against a local sink mailserver and a local graph server, nothing leaves this host.
+
+Every scenario also runs in baseline mode, which starts nagiosmailer the way it used to: with requests and urllib2
+imported up front and a fresh socket.getfqdn() every time the host name is needed, instead of the name remembered in
+the cache directory. How much the lookups cost depends on the resolver of this host.
+
+usage: benchmarks/startup.py [--runs 20]
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+NAGIOSMAILER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nagiosmailer.py')
+ICONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'icons')
+
+BASEENV = {'NAGIOS_NOTIFICATIONTYPE': 'PROBLEM',
+           'NAGIOS_SERVICEDISPLAYNAME': 'check_load',
+           'NAGIOS_HOSTDISPLAYNAME': 'myhost.example.com',
+           'NAGIOS_HOSTADDRESS': '127.0.0.1',
+           'NAGIOS_SERVICESTATE': 'CRITICAL',
+           'NAGIOS_LONGDATETIME': 'Mon Oct 19 12:00:00 CEST 2026',
+           'NAGIOS_SERVICEOUTPUT': 'CRITICAL - load average: 30.00, 25.00, 20.00',
+           'NAGIOS_SERVICEEVENTID': '1001',
+           'NAGIOS_LASTSERVICEEVENTID': '1000',
+           'NAGIOS_CONTACTEMAIL': 'oncall@example.com'}
+
+# modules that a plain text notification should not need
+HEAVYMODULES = ['requests', 'urllib2', 'multiprocessing']
+
+
+def importReport():
+    """import nagiosmailer in a fresh interpreter and report the import time and the heavy modules it loaded"""
+    code = ("import sys, time; sys.path.insert(0, %r); t = time.time(); import nagiosmailer; "
+            "print '%%.1f' %% ((time.time() - t) * 1000); print ' '.join(m for m in %r if m in sys.modules)" %
+            (os.path.dirname(NAGIOSMAILER), HEAVYMODULES))
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code]).splitlines()
+    return float(output[0]), output[1] if len(output) > 1 else ''
+
+
+def baseline(args):
+    """run nagiosmailer in this process the way it started before the HTTP stack was loaded lazily and the host name was
+    remembered: import requests and urllib2 first, and look up the host name every time it is needed"""
+    import requests
+    import urllib2
+    sys.path.insert(0, os.path.dirname(NAGIOSMAILER))
+    import nagiosmailer
+    nagiosmailer.getFqdn = lambda cacheDirectory=None: socket.getfqdn()
+    sys.argv = [NAGIOSMAILER] + args
+    nagiosmailer.main()
+
+
+def run(env, args, runs, baselineMode=False):
+    """start nagiosmailer runs times and return the wallclock time of each run in milliseconds"""
+    if baselineMode:
+        command = [sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--baseline'] + args
+    else:
+        command = [sys.executable, '-W', 'ignore', NAGIOSMAILER] + args
+    timings = []
+    for num in range(runs):
+        # a new event every run, so that no run reuses the mail rendered by the previous one
+        env['NAGIOS_SERVICEEVENTID'] = str(int(env['NAGIOS_SERVICEEVENTID']) + 1)
+        start = time.time()
+        subprocess.check_call(command, env=env)
+        timings.append((time.time() - start) * 1000)
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure the startup time of nagiosmailer")
+    parser.add_argument("--runs", type=int, default=20, help="number of runs per scenario (default: 20)")
+    parser.add_argument("--baseline", action="store_true", help=argparse.SUPPRESS)
+    options, rest = parser.parse_known_args()
+    if options.baseline:
+        baseline(rest)
+        return
+    # imported here, so that the baseline runs do not pay for importing the servers
+    import servers
+
+    workdir = tempfile.mkdtemp(prefix='nagiosmailer-bench')
+    smtpServer, httpServer = servers.start()
+
+    args = ['--configfile', os.path.join(workdir, 'none.conf'),
+            '--logFile', os.path.join(workdir, 'nagiosmailer.log'),
+            '--cacheDirectory', os.path.join(workdir, 'cache'),
+            '--imgDirectory', ICONS,
+            '--smtpPort', str(smtpServer.socket.getsockname()[1])]
+    graphUrl = 'http://127.0.0.1:%d/graph?title=load__AMPERSAND__size=20000' % httpServer.server_port
+    scenarios = [('plain text', {}, []),
+                 ('graph', {'NAGIOS__SERVICEGRAPHURL1': graphUrl}, []),
+                 ('graph nocache', {'NAGIOS__SERVICEGRAPHURL1': graphUrl}, ['--cacheTtl', '0'])]
+
+    try:
+        importTime, loaded = importReport()
+        print "import nagiosmailer: %.1f ms, heavy modules loaded: %s" % (importTime, loaded or 'none')
+        print
+        print "%-14s %-9s %8s %8s %8s" % ('scenario', 'mode', 'min', 'p50', 'max')
+        for name, extra, extraArgs in scenarios:
+            env = dict(os.environ)
+            env.update(BASEENV)
+            env.update(extra)
+            for mode in ('baseline', 'current'):
+                # the first run fills the cache directory, like on any nagios server that has sent a mail before
+                run(env, args + extraArgs, 1, mode == 'baseline')
+                timings = run(env, args + extraArgs, options.runs, mode == 'baseline')
+                print "%-14s %-9s %6.1fms %6.1fms %6.1fms" % (name, mode, timings[0], timings[len(timings) / 2],
+                                                             timings[-1])
+    finally:
+        servers.stop(smtpServer, httpServer)
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,25 @@ commandline options for this script:
 --timeout       : timeout (in seconds) for retrieving remote data
 --configfile    : configfile to put options in
 --subjectPrefix : prefix for mail subject
+--cacheDirectory: directory for the graph cache shared between processes
+--cacheTtl      : seconds a cached graph or webpage stays valid, 0 disables caching
+--cacheMaxSize  : maximum size (in bytes) of the graph cache
+--mode          : direct (send right away), enqueue (spool for the delivery daemon) or daemon (run the delivery daemon)
+--spoolDirectory: spool directory for notifications waiting for the delivery daemon
+--workers       : number of worker processes of the delivery daemon
+--retries       : number of times the delivery daemon retries a failed notification
+--retryDelay    : seconds before the first retry, later retries wait longer
+--smtpHost      : mailserver to send mail to
+--smtpPort      : port of the mailserver
+--smtpTimeout   : timeout (in seconds) for every command sent to the mailserver
+--batchRecipients: let the delivery daemon send one mail to all contacts notified about the same event (yes/no)
+--digestWindow  : seconds the delivery daemon collects notifications for a contact in a digest, 0 disables digests
+--digestThreshold: notifications for a contact within digestWindow that are sent right away, before digests start
+--digestGraphBudget: maximum size (in bytes) of the graphs attached to a digest mail, base64 encoding included
+--breakerThreshold: consecutive failures after which a graph host is skipped, 0 never skips
+--breakerCooldown: seconds to skip a failing graph host before trying it again
+--graphBudget   : maximum size (in bytes) of the graphs attached to a mail, base64 encoding included. Larger graphs are
+                  shrunk or linked
 
 recognized custom attributes for nagios services:
   _GRAPHURLn : one or more URLs that return an image directly (of type .png)
@@ -47,21 +66,24 @@ Date:   april 2013
 
 # TODO: make script usable for hostmails too (and edit commandlinedescription when this is done)
 
-import argparse
+# only modules that are cheap to load are imported here. '--mode enqueue' has to be quick, Nagios waits for it, so
+# argparse, smtplib, the email package and logging.handlers are imported where they are used
+import codecs
+import contextlib
+import errno
+import fcntl
+import hashlib
 import socket
 import logging
-import logging.handlers
 import os
 import re
-import requests
-import smtplib
-import urllib2
+import signal
+import sys
+import tempfile
+import time
 
 from ConfigParser import ConfigParser, ParsingError
-from BeautifulSoup import *
-from email.mime.image import MIMEImage
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from HTMLParser import HTMLParser
 
 __author__ = "Reinoud van Leeuwen"
 __version__ = "1.0.0"
@@ -73,9 +95,548 @@ __status__ = "Production"
 # Display these fields in bold in HTML
 BOLDVARS = ['Host', 'Service']
 
+# Fields to display in the mail, with the Nagios environment variables they are taken from
+NAGIOSDICT = {'Notification Type': 'NAGIOS_NOTIFICATIONTYPE',
+              'Service': 'NAGIOS_SERVICEDISPLAYNAME',
+              'Host': 'NAGIOS_HOSTDISPLAYNAME',
+              'Address': 'NAGIOS_HOSTADDRESS',
+              'State': 'NAGIOS_SERVICESTATE',
+              'Docs': 'NAGIOS_SERVICENOTESURL',
+              'Date/Time': 'NAGIOS_LONGDATETIME'}
 
-def sendGraphEmail(logger, graph_urls, subject, sender, receiver, textBody, htmlBody, headers, imgDirectory, timeout):
-    """Builds and sends an email with inline graph(s), and provide plaintext alternative.
+# default configfile and spool directory, also used by quickEnqueue()
+CONFIGFILE = '/etc/nagiosmailer/nagiosmailer.conf'
+SPOOLDIRECTORY = '/var/spool/nagiosmailer'
+
+# bytes to read from a webpage at a time while looking for an image
+READCHUNK = 16384
+
+# characters kept between chunks while searching a webpage for its anchor, so that tags split over two chunks are found
+SKIPOVERLAP = 1024
+
+# the <base href> of a webpage, for the part that is searched for the anchor instead of parsed
+BASEHREF = re.compile(r'''<base\s[^>]*?href\s*=\s*["']?([^"'\s>]+)''', re.IGNORECASE)
+
+# the charset in a <meta> tag of a webpage
+METACHARSET = re.compile(r'''<meta\s[^>]*?charset\s*=\s*["']?([\w.:-]+)''', re.IGNORECASE)
+
+# characters that stay as they are when a found image URL is quoted
+URLSAFE = "%/:=&?~#+!$,;'@()*[]"
+
+# seconds the fully qualified name of this host is remembered in the cache directory
+FQDNTTL = 3600
+
+# fully qualified name of this host, filled by getFqdn()
+fqdn = []
+
+# scales to try, in this order, when a graph has to be shrunk to fit in a mail
+SHRINKSCALES = [1, 0.75, 0.5, 0.35, 0.25]
+
+# state icons as MIME parts, filled by stateIcon()
+stateIcons = {}
+
+# seconds spent per phase of sending mail, filled by timedPhase() and used by benchmarks/endtoend.py
+phaseTimes = {}
+
+# seconds spent in nested phases, for each phase in progress
+phaseStack = []
+
+# phases of sending a single mail, reset by notify() so that a delivery worker does not add up the times of all its mails
+MAILPHASES = ['mime', 'parseWebpage', 'fetch', 'smtp']
+
+# number of lockfiles in the cache directory shared by all URLs, see UrlCache.lock()
+LOCKSTRIPES = 16
+
+# seconds between two scans of the spool directory by the delivery daemon
+POLLINTERVAL = 0.5
+
+# seconds after which a claimed notification is considered abandoned by a crashed worker and delivered again
+STALEAFTER = 600
+
+
+@contextlib.contextmanager
+def timedPhase(name):
+    """add the time spent in a with-block to phaseTimes[name]. Time spent in nested phases is not counted twice.
+
+    :param name: name of the phase
+    :type name: string
+    """
+    start = time.time()
+    phaseStack.append(0.0)
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        phaseTimes[name] = phaseTimes.get(name, 0.0) + elapsed - phaseStack.pop()
+        if phaseStack:
+            phaseStack[-1] += elapsed
+
+
+class UrlCache(object):
+    """A small on-disk cache for remote content (graph images, dashboard pages) that is shared between nagiosmailer
+    processes. Nagios starts a new process for every contact of every notification, so during an outage the same
+    URLs would otherwise be fetched over and over again.
+
+    Every entry is a single file named after the sha1 of the normalised URL ('__AMPERSAND__' replaced by '&'). The
+    first line of the file holds the creation time and the content type, the rest is the content itself. Entries are
+    written to a temporary file and renamed into place, so readers never see a half written entry. The modification
+    time of an entry is bumped on every hit and is used for least recently used eviction when the total size of the
+    cache exceeds maxSize. Eviction is done by one process at a time, guarded by a lockfile.
+
+    Processes that are about to produce the same entry can serialise on lock(), so that only the first one does the
+    work and the others find the entry in the cache.
+    """
+
+    def __init__(self, logger, directory, ttl, maxSize):
+        """
+        :param logger: logobject
+        :type logger: logging.getlogger()
+        :param directory: directory to store cache entries in, created when it does not exist
+        :type directory: string
+        :param ttl: seconds a cache entry stays valid
+        :type ttl: int
+        :param maxSize: maximum total size (in bytes) of all cache entries
+        :type maxSize: int
+        """
+        self.logger = logger
+        self.directory = directory
+        self.ttl = ttl
+        self.maxSize = maxSize
+        try:
+            os.makedirs(directory, 0700)
+        except OSError as inst:
+            if inst.errno != errno.EEXIST:
+                raise
+
+    def _path(self, url):
+        url = url.replace('__AMPERSAND__', '&')
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+
+    def get(self, url):
+        """lookup an url in the cache
+
+        :param url: URL to look up
+        :type url: string
+        :returns a tuple (contenttype, content) or None when the URL is not cached or expired
+        :rtype: tuple
+        """
+        path = self._path(url)
+        try:
+            with open(path, 'rb') as fp:
+                created, contentType = fp.readline().rstrip('\n').split('\t', 1)
+                if float(created) + self.ttl < time.time():
+                    self.logger.debug("cache entry for %s expired" % url)
+                    return None
+                content = fp.read()
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        self.logger.debug("cache hit for %s" % url)
+        return contentType, content
+
+    def put(self, url, contentType, content):
+        """store content for an url in the cache and evict old entries when the cache grows too big
+
+        :param url: URL to store the content for
+        :type url: string
+        :param contentType: value of the content-type header of the content
+        :type contentType: string
+        :param content: the content itself
+        :type content: string
+        :returns: None
+        """
+        try:
+            fd, tmpPath = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write("%s\t%s\n" % (time.time(), contentType))
+                fp.write(content)
+            os.rename(tmpPath, self._path(url))
+            self.logger.debug("stored %s in cache" % url)
+        except (IOError, OSError) as inst:
+            self.logger.warning("could not store %s in cache: %s" % (url, inst))
+            return
+        self.evict()
+
+    @contextlib.contextmanager
+    def lock(self, url):
+        """hold an exclusive lock for an url while producing its content. URLs share LOCKSTRIPES lockfiles, so the
+        number of lockfiles stays small. When the lockfile cannot be opened, the block runs without lock.
+
+        :param url: URL to lock
+        :type url: string
+        """
+        name = '.lock%d' % (int(os.path.basename(self._path(url)), 16) % LOCKSTRIPES)
+        try:
+            lockfp = open(os.path.join(self.directory, name), 'a')
+        except IOError as inst:
+            self.logger.warning("could not open cache lockfile: %s" % inst)
+            yield
+            return
+        try:
+            fcntl.flock(lockfp, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(lockfp, fcntl.LOCK_UN)
+            lockfp.close()
+
+    def evict(self):
+        """remove expired entries and the least recently used entries until the cache fits in maxSize
+
+        When another process is already evicting, this is skipped.
+
+        :returns: None
+        """
+        try:
+            lockfp = open(os.path.join(self.directory, '.lock'), 'a')
+        except IOError as inst:
+            self.logger.warning("could not open cache lockfile: %s" % inst)
+            return
+        try:
+            fcntl.flock(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockfp.close()
+            return
+        try:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.startswith('.'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            entries.sort()
+            totalSize = sum(size for mtime, size, name in entries)
+            oldest = time.time() - self.ttl
+            for mtime, size, name in entries:
+                if totalSize <= self.maxSize and mtime >= oldest:
+                    continue
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    totalSize -= size
+                except OSError:
+                    pass
+        finally:
+            fcntl.flock(lockfp, fcntl.LOCK_UN)
+            lockfp.close()
+
+
+def getCache(logger, options):
+    """create the shared UrlCache from the options, or return None when caching is disabled or not possible
+
+    :param logger: logobject
+    :type logger: logging.getlogger()
+    :param options: parsed options
+    :type options: argparse.Namespace
+    :returns: cache object or None
+    :rtype: UrlCache
+    """
+    ttl = int(options.cacheTtl)
+    if ttl <= 0:
+        logger.debug("caching disabled")
+        return None
+    try:
+        return UrlCache(logger, options.cacheDirectory, ttl, int(options.cacheMaxSize))
+    except OSError as inst:
+        logger.warning("not using cache directory %s: %s" % (options.cacheDirectory, inst))
+        return None
+
+
+class CircuitBreaker(object):
+    """Remembers, shared between nagiosmailer processes, which graph hosts are failing, so that not every process waits
+    for the full timeout on them.
+
+    After threshold consecutive failures for a host the breaker opens and fetches from that host are skipped for
+    cooldown seconds. After that a single trial fetch is allowed; when it succeeds the breaker closes again, otherwise
+    it stays open for another cooldown. The state is kept in a small file with a line 'host failures opened trial' per
+    failing host, guarded by a lock.
+    """
+
+    def __init__(self, logger, path, threshold, cooldown):
+        """
+        :param logger: logobject
+        :type logger: logging.getlogger()
+        :param path: statefile
+        :type path: string
+        :param threshold: consecutive failures after which the breaker for a host opens
+        :type threshold: int
+        :param cooldown: seconds to skip a host before trying it again
+        :type cooldown: int
+        """
+        self.logger = logger
+        self.path = path
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def _update(self, host, change):
+        """apply change to the state of host while holding the lock on the statefile
+
+        :param host: host to change the state for
+        :type host: string
+        :param change: function that takes the state of the host (a list [failures, opened, trial]) and returns the
+                       new state (or None to forget the host) and a result
+        :type change: function
+        :returns: the result of change
+        """
+        with open(self.path, 'a+') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                fp.seek(0)
+                hosts = {}
+                for line in fp:
+                    try:
+                        name, failures, opened, trial = line.split()
+                        hosts[name] = [int(failures), float(opened), float(trial)]
+                    except ValueError:
+                        pass
+                # hosts without failures are not in the statefile
+                known = [0, 0.0, 0.0]
+                previous = hosts.get(host)
+                state, result = change(previous or known)
+                if (state or known) != (previous or known):
+                    if state is None:
+                        hosts.pop(host, None)
+                    else:
+                        hosts[host] = state
+                    fp.seek(0)
+                    fp.truncate()
+                    for name, (failures, opened, trial) in hosts.iteritems():
+                        fp.write("%s %d %f %f\n" % (name, failures, opened, trial))
+                    fp.flush()
+                return result
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def allow(self, url):
+        """decide whether an url may be fetched
+
+        :param url: URL to fetch
+        :type url: string
+        :returns: False when the breaker for the host of the URL is open
+        :rtype: bool
+        """
+        def change(state):
+            failures, opened, trial = state
+            now = time.time()
+            if failures < self.threshold:
+                return state, True
+            if now < opened + self.cooldown or now < trial + self.cooldown:
+                return state, False
+            # cooldown has passed and no other process is trying: this one may try
+            return [failures, opened, now], True
+
+        host = hostOf(url)
+        try:
+            allowed = self._update(host, change)
+        except (IOError, OSError) as inst:
+            self.logger.warning("could not read circuit breaker state: %s" % inst)
+            return True
+        if not allowed:
+            self.logger.info("skipping %s, %s is failing" % (url, host))
+        return allowed
+
+    def record(self, url, success):
+        """remember the result of fetching an url
+
+        :param url: URL that was fetched
+        :type url: string
+        :param success: whether the host responded
+        :type success: bool
+        :returns: None
+        """
+        def change(state):
+            failures, opened, trial = state
+            if success:
+                return None, None
+            failures += 1
+            if failures >= self.threshold:
+                return [failures, time.time(), 0.0], None
+            return [failures, opened, trial], None
+
+        try:
+            self._update(hostOf(url), change)
+        except (IOError, OSError) as inst:
+            self.logger.warning("could not write circuit breaker state: %s" % inst)
+
+
+def hostOf(url):
+    """
+    :param url: an URL
+    :type url: string
+    :returns: the host (and port) part of the URL
+    :rtype: string
+    """
+    # loaded here, so that notifications without graphs do not pay for importing it
+    import urlparse
+    return urlparse.urlsplit(url).netloc
+
+
+def getBreaker(logger, options):
+    """create the shared CircuitBreaker from the options, or return None when it is disabled or not possible
+
+    :param logger: logobject
+    :type logger: logging.getlogger()
+    :param options: parsed options
+    :type options: argparse.Namespace
+    :returns: circuit breaker or None
+    :rtype: CircuitBreaker
+    """
+    threshold = int(options.breakerThreshold)
+    if threshold <= 0:
+        logger.debug("circuit breaker disabled")
+        return None
+    try:
+        os.makedirs(options.cacheDirectory, 0700)
+    except OSError as inst:
+        if inst.errno != errno.EEXIST:
+            logger.warning("not using circuit breaker in %s: %s" % (options.cacheDirectory, inst))
+            return None
+    return CircuitBreaker(logger, os.path.join(options.cacheDirectory, '.breakers'), threshold,
+                          int(options.breakerCooldown))
+
+
+def fetchGraph(logger, graph_url, timeout, cache=None, breaker=None):
+    """retrieve a graph image
+
+    :param logger: logobject
+    :type logger: logging.getlogger
+    :param graph_url: URL of the image. Note '__AMPERSAND__' in the URL will be replaced by '&'
+    :type graph_url: string
+    :param timeout: timeout (in seconds) for retrieving remote content
+    :type timeout: int
+    :param cache: shared cache for retrieved images, or None to always fetch them
+    :type cache: UrlCache
+    :param breaker: shared circuit breaker for failing graph hosts
+    :type breaker: CircuitBreaker
+    :returns: a tuple (imagetype, content), or None when the URL did not return an image
+    :rtype: tuple
+    """
+    graph_url = graph_url.replace('__AMPERSAND__', '&')
+    logger.debug("graphurl to fetch is: %s", graph_url)
+
+    cached = cache and cache.get(graph_url)
+    if cached:
+        contentType, content = cached
+        kind, imgtype = contentType.split('/')
+    elif breaker and not breaker.allow(graph_url):
+        return None
+    else:
+        # loaded here, so that notifications without graphs do not pay for importing it
+        import requests
+        responded = False
+        try:
+            graph = requests.get(graph_url, timeout=timeout, verify=False)
+            responded = graph.status_code < 500
+            contentType, content = graph.headers['content-type'], graph.content
+            kind, imgtype = contentType.split('/')
+            logger.debug("successfully retrieved %s of type %s" % (kind, imgtype))
+        except requests.exceptions.Timeout as inst:
+            logger.warning("did not receive %s in time: %s" % (graph_url, inst))
+            kind = ''
+        except Exception as inst:
+            logger.warning("did not receive %s for reason: %s" % (graph_url, inst))
+            kind = ''
+        if breaker:
+            breaker.record(graph_url, responded)
+        if kind == 'image' and cache:
+            cache.put(graph_url, contentType, content)
+
+    if kind != 'image':
+        logger.warning("URL %s returns no image but %s" % (graph_url, kind))
+        return None
+    return imgtype, content
+
+
+def stateIcon(logger, imgDirectory, state):
+    """return the icon for a service state as MIME part. Icons are read and encoded only once per process.
+
+    :param logger: logobject
+    :type logger: logging.getlogger
+    :param imgDirectory: local directory where images are stored
+    :type imgDirectory: string
+    :param state: service state (OK, WARNING, CRITICAL, UNKNOWN)
+    :type state: string
+    :returns: the icon, or None when it could not be read
+    :rtype: MIMEImage
+    """
+    from email.mime.image import MIMEImage
+    stateImage = state + '.png'
+    filename = imgDirectory + '/' + stateImage
+    if filename not in stateIcons:
+        try:
+            msgImage = MIMEImage(open(filename, 'rb').read())
+            msgImage.add_header('Content-ID', '<%s@%s>' % (stateImage, getFqdn()))
+            msgImage.add_header('Content-Disposition', 'inline', filename=stateImage)
+            stateIcons[filename] = msgImage
+            logger.debug("succesfully added image %s" % stateImage)
+        except Exception as inst:
+            logger.warning("error adding image %s: %s" % (stateImage, inst))
+            return None
+    return stateIcons[filename]
+
+
+def encodedSize(size):
+    """
+    :param size: size (in bytes) of an attachment
+    :type size: int
+    :returns: size (in bytes) of the attachment once it is base64 encoded in a mail, line breaks included
+    :rtype: int
+    """
+    encoded = (size + 2) / 3 * 4
+    return encoded + encoded / 76
+
+
+def shrinkGraph(logger, imgtype, content, size):
+    """make a graph image fit in size bytes, by recompressing it as a palette PNG and downscaling it when needed.
+    Graphs have few colours, so the palette alone usually does most of the work. Needs PIL.
+
+    :param logger: logobject
+    :type logger: logging.getlogger
+    :param imgtype: subtype of the image (png, jpeg, ...)
+    :type imgtype: string
+    :param content: the image
+    :type content: string
+    :param size: maximum size (in bytes) of the image as attached to the mail, see encodedSize()
+    :type size: int
+    :returns: a tuple (imagetype, content), or None when the image cannot be made small enough
+    :rtype: tuple
+    """
+    if encodedSize(len(content)) <= size:
+        return imgtype, content
+    if size <= 0:
+        return None
+    try:
+        # optional, and only needed for oversized graphs
+        from PIL import Image
+        from cStringIO import StringIO
+    except ImportError:
+        logger.debug("PIL is not installed, cannot shrink graph of %d bytes" % len(content))
+        return None
+    try:
+        image = Image.open(StringIO(content)).convert('RGB')
+        width, height = image.size
+        for scale in SHRINKSCALES:
+            resized = image
+            if scale < 1:
+                resized = image.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.ANTIALIAS)
+            out = StringIO()
+            resized.convert('P', palette=Image.ADAPTIVE).save(out, 'PNG', optimize=True)
+            if encodedSize(out.tell()) <= size:
+                logger.debug("shrunk graph from %d to %d bytes at scale %s" % (len(content), out.tell(), scale))
+                return 'png', out.getvalue()
+    except Exception as inst:
+        logger.warning("could not shrink graph: %s" % inst)
+    return None
+
+
+def buildGraphEmail(logger, graph_urls, subject, sender, textBody, htmlBody, headers, imgDirectory, timeout,
+                    cache=None, breaker=None, budget=0):
+    """Builds an email with inline graph(s), and provide plaintext alternative.
+
+    The mail is rendered without recipient headers, sendGraphEmail() adds these. When the graphs together are larger
+    than budget as attached to the mail (base64 encoded, so about 4/3 of their size), they are shrunk to fit, or linked
+    instead of attached when that is not possible.
 
     :param logger: logobject
     :type logger: logging.getlogger
@@ -85,8 +646,6 @@ def sendGraphEmail(logger, graph_urls, subject, sender, receiver, textBody, html
     :type subject: string
     :param sender: an email address
     :type sender: string
-    :param receiver: single email addresses to send to.
-    :type receiver: string
     :param textBody: text alternative body
     :type textBody: string
     :param htmlBody: html alternavive body
@@ -97,92 +656,287 @@ def sendGraphEmail(logger, graph_urls, subject, sender, receiver, textBody, html
     :type imgDirectory: string
     :param timeout: timeout (in seconds) for retrieving remote content
     :type timeout: int
-    :returns: None
+    :param cache: shared cache for retrieved images, or None to always fetch them
+    :type cache: UrlCache
+    :param breaker: shared circuit breaker for failing graph hosts
+    :type breaker: CircuitBreaker
+    :param budget: maximum size (in bytes) of all graphs together as attached to the mail, 0 for no maximum
+    :type budget: int
+    :returns: the rendered mail
+    :rtype: string
     """
 
+    from email.mime.image import MIMEImage
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
     logger.debug("start composing mail")
     msg = MIMEMultipart()
-    msg['To'] = receiver
     msg['From'] = sender
     msg['Subject'] = subject
     msg.add_header('To:', sender)
     msg.preamble = 'This is a multi-part message in MIME format.'
     for header, value in headers.iteritems():
+        # recipient headers are added by sendGraphEmail(), so the rendered mail can be shared between contacts
+        if header.lower() in ('to', 'reply-to'):
+            continue
         msg.add_header(header, value)
         logger.debug("added header %s" % header)
 
+    images = []
+    msgImage = stateIcon(logger, imgDirectory, getSingleEnvVar('NAGIOS_SERVICESTATE'))
+    if msgImage is not None:
+        images.append(msgImage)
+
+    graphs = {}
+    with timedPhase('fetch'):
+        for num, graph_url in enumerate(graph_urls):
+            graph = fetchGraph(logger, graph_url, timeout, cache, breaker)
+            if graph is not None:
+                graphs[num] = graph
+
+    if budget:
+        # smallest graphs first, every graph gets an equal share of what the smaller ones left over
+        remaining = budget
+        bySize = sorted(graphs, key=lambda num: len(graphs[num][1]))
+        for done, num in enumerate(bySize):
+            graph = shrinkGraph(logger, graphs[num][0], graphs[num][1], remaining / (len(bySize) - done))
+            if graph is None:
+                logger.info("graph %s does not fit in the mail, linking it" % graph_urls[num])
+                del graphs[num]
+                htmlBody = htmlBody.replace('<img src="cid:graph%s">' % num,
+                                            '<a href="%s">graph not attached, click to view</a>' %
+                                            graph_urls[num].replace('__AMPERSAND__', '&'))
+                continue
+            graphs[num] = graph
+            remaining -= encodedSize(len(graph[1]))
+
+    for num in sorted(graphs):
+        imgtype, content = graphs[num]
+        imgpart = MIMEImage(content, _subtype=imgtype)
+        imgpart.add_header('Content-Disposition', 'attachment', filename="graph%s" % num)
+        imgpart.add_header('Content-ID', '<graph%s>' % num)
+        images.append(imgpart)
+        logger.debug("attached image %s to mail" % graph_urls[num])
+
     msgAlternative = MIMEMultipart('alternative')
     msgAlternative.attach(MIMEText(textBody, 'plain'))
 
     # html part and images need to be in a 'related' Mime container
     related = MIMEMultipart('related')
     related.attach(MIMEText(htmlBody, 'html'))
+    for imgpart in images:
+        related.attach(imgpart)
 
     msgAlternative.attach(related)
 
     msg.attach(msgAlternative)
 
-    stateImage = getSingleEnvVar('NAGIOS_SERVICESTATE') + '.png'
-    try:
-        filename = imgDirectory + '/' + stateImage
-        msgImage = MIMEImage(open(filename, 'rb').read())
-        msgImage.add_header('Content-ID', '<%s@%s>' % (stateImage, socket.getfqdn()))
-        msgImage.add_header('Content-Disposition', 'inline', filename=stateImage)
-        related.attach(msgImage)
-        logger.debug("succesfully added image %s" % stateImage)
-    except Exception as inst:
-        logger.warning("error adding image %s: %s" % (stateImage, inst))
-
-    for num, graph_url in enumerate(graph_urls):
-        graph_url = graph_url.replace('__AMPERSAND__', '&')
-        logger.debug("graphurl to fetch is: %s", graph_url)
+    return msg.as_string()
 
-        try:
-            graph = requests.get(graph_url, timeout=timeout, verify=False)
-            kind, imgtype = graph.headers['content-type'].split('/')
-            logger.debug("successfully retrieved %s of type %s" % (kind, imgtype))
-        except requests.exceptions.Timeout as inst:
-            logger.warning("did not receive %s in time: %s" % (graph_url, inst))
-            kind = ''
-        except Exception as inst:
-            logger.warning("did not receive %s for reason: %s" % (graph_url, inst))
-            kind = ''
 
-        if kind != 'image':
-            logger.warning("URL %s returns no image but %s" % (graph_url, kind))
-        else:
-            imgpart = MIMEImage(graph.content, _subtype=imgtype)
-            imgpart.add_header('Content-Disposition', 'attachment', filename="graph%s" % num)
-            imgpart.add_header('Content-ID', '<graph%s>' % num)
-            related.attach(imgpart)
-            logger.debug("attached image %s to mail" % graph_url)
-
-    if 'Message-ID' in headers:
-        msgidstr = ", MessageID: '%s'" % headers['Message-ID']
-    else:
-        msgidstr = ""
+def sendGraphEmail(logger, message, subject, sender, receivers, smtp):
+    """Address a mail rendered by buildGraphEmail() and send it.
 
-    s = smtplib.SMTP()
+    :param logger: logobject
+    :type logger: logging.getlogger
+    :param message: mail as rendered by buildGraphEmail()
+    :type message: string
+    :param subject: Email subject line, for logging
+    :type subject: string
+    :param sender: an email address
+    :type sender: string
+    :param receivers: email addresses to send to, all in a single SMTP transaction
+    :type receivers: list
+    :param smtp: open connection to send the mail over, see smtpConnect()
+    :type smtp: smtplib.SMTP
+    :returns: True when the mail was handed over to the mailserver
+    :rtype: bool
+    """
+    addresses = ', '.join(receivers)
+    message = "To: %s\nreply-to: %s\n%s" % (addresses, addresses, message)
     try:
-        s.connect()
-        s.sendmail(sender, receiver, msg.as_string())
-        s.close()
-        logger.info("sent mail OK. Subject: '%s' %s" % (subject, msgidstr))
+        smtp.sendmail(sender, receivers, message)
+        logger.info("sent mail OK. Subject: '%s' To: '%s'" % (subject, addresses))
+        return True
     except Exception as out:
         logger.error("Sending mail failed: %s" % out)
+        return False
+
+
+def renderKey(env, options):
+    """return a key that is the same for all contacts notified about the same event, to share the rendered mail
+
+    :param env: environment variables of the notification
+    :type env: dict
+    :param options: parsed options
+    :type options: argparse.Namespace
+    :returns: the key
+    :rtype: string
+    """
+    fields = ['NAGIOS_SERVICEEVENTID', 'NAGIOS_NOTIFICATIONTYPE', 'NAGIOS_NOTIFICATIONNUMBER', 'NAGIOS_LONGDATETIME',
+              'NAGIOS_HOSTNAME', 'NAGIOS_SERVICEDESC', 'NAGIOS_SERVICESTATE']
+    return "mail:%s|%s|%s" % ('|'.join(env.get(field, '') for field in fields),
+                              options.subjectPrefix, options.mailsender)
+
+
+class ImageFinder(HTMLParser):
+    """Scans a webpage for the first 'img src', optionally the first one after '<a name=anchor>'. The page is fed in
+    chunks of unicode, and feeding can stop as soon as src is set: there is no need to download or parse the rest of
+    the page.
+    """
+
+    def __init__(self, anchor=None):
+        """
+        :param anchor: only look for images after the anchor with this name
+        :type anchor: string
+        """
+        HTMLParser.__init__(self)
+        self.anchor = anchor
+        self.afterAnchor = anchor is None
+        self.base = None
+        self.src = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.src is not None:
+            return
+        attrs = dict(attrs)
+        if tag == 'base' and attrs.get('href'):
+            self.base = attrs['href']
+        elif tag == 'a' and self.anchor is not None and attrs.get('name') == self.anchor:
+            self.afterAnchor = True
+        elif tag == 'img' and self.afterAnchor and attrs.get('src'):
+            self.src = attrs['src']
+
+    handle_startendtag = handle_starttag
+
+
+def pageCharset(declared, chunk):
+    """decide how to decode a webpage: with the charset of the response, or else the one in a <meta> tag at the start
+    of the page, or else as utf-8 when the start of the page is valid utf-8, and as latin-1 otherwise
+
+    :param declared: charset from the content-type header of the response, or None
+    :type declared: string
+    :param chunk: the first chunk of the page
+    :type chunk: string
+    :returns: name of the charset
+    :rtype: string
+    """
+    meta = METACHARSET.search(chunk)
+    for charset in (declared, meta and meta.group(1)):
+        if charset:
+            try:
+                return codecs.lookup(charset).name
+            except LookupError:
+                pass
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(chunk)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
 
+def findImage(logger, url, anchor, timeout, breaker=None):
+    """read a webpage in chunks until the first image (after the anchor) is found
 
-def parseWebpage(logger, urls, timeout):
+    The result is recorded in the breaker once, after the page has been read as far as needed. Only the host failing to
+    respond, or stalling halfway, counts as a failure: a page that cannot be parsed says nothing about the host.
+
+    :param logger: logobject
+    :type logger: logging.getlogger()
+    :param url: URL of the webpage, without anchor
+    :type url: string
+    :param anchor: name of the anchor after which to look, or None
+    :type anchor: string
+    :param timeout: timeout (in seconds) for retrieving remote content
+    :type timeout: int
+    :param breaker: shared circuit breaker for failing dashboard hosts
+    :type breaker: CircuitBreaker
+    :returns: absolute URL of the image, or None when the page contains no such image
+    :rtype: string
+    """
+    # loaded here, so that notifications without dashboards do not pay for importing these
+    import urllib
+    import urllib2
+    import urlparse
+
+    finder = ImageFinder(anchor)
+    try:
+        response = urllib2.urlopen(url, None, timeout=timeout)
+    except urllib2.HTTPError as inst:
+        # an HTTP error below 500 still means the host is up
+        if breaker:
+            breaker.record(url, inst.code < 500)
+        raise
+    except (urllib2.URLError, socket.error):
+        if breaker:
+            breaker.record(url, False)
+        raise
+    try:
+        # HTMLParser cannot handle undecoded pages with non-ascii characters, so decode them as they come in
+        decoder = None
+        # parsing is slow, so with an anchor the page is only searched until the anchor and parsed from there
+        if anchor is None:
+            anchorTag = None
+        else:
+            anchorTag = re.compile(r'''(?<![\w-])name\s*=\s*["']?%s["'\s/>]''' % re.escape(anchor), re.IGNORECASE)
+        skipped = u''
+        size = 0
+        while finder.src is None:
+            chunk = response.read(READCHUNK)
+            if not chunk:
+                break
+            size += len(chunk)
+            if decoder is None:
+                charset = pageCharset(response.info().getparam('charset'), chunk)
+                decoder = codecs.getincrementaldecoder(charset)('replace')
+            text = decoder.decode(chunk)
+            if anchorTag is not None:
+                skipped += text
+                found = anchorTag.search(skipped)
+                end = found.start() if found else len(skipped)
+                base = BASEHREF.search(skipped, 0, end)
+                if base and finder.base is None:
+                    finder.base = finder.unescape(base.group(1))
+                if not found:
+                    skipped = skipped[-SKIPOVERLAP:]
+                    continue
+                text = skipped[max(0, skipped.rfind('<', 0, end)):]
+                anchorTag = None
+            finder.feed(text)
+        logger.debug("read %d bytes of %s" % (size, url))
+        pageUrl = response.geturl()
+        # only now, a host that answers but then stalls the page would otherwise never open the breaker
+        if breaker:
+            breaker.record(url, True)
+    except socket.error:
+        # the host stopped sending halfway, or too slowly
+        if breaker:
+            breaker.record(url, False)
+        raise
+    finally:
+        response.close()
+    if finder.src is None:
+        return None
+    link = urlparse.urljoin(urlparse.urljoin(pageUrl, finder.base or ''), finder.src)
+    return urllib.quote(link.encode('utf-8'), URLSAFE)
+
+
+def parseWebpage(logger, urls, timeout, cache=None, breaker=None):
     """Parse the webpages in the list of urls and return the first 'img src' URL in each page as a list
 
     Note: when the URL contains an anchor ('#'), return the first img src after that anchor
 
-    In the future we might want to extend this function with some (short timed) caching for urllib2
-
     :param logger: logobject
     :type logger: logging.getlogger()
     :param urls: a list of URLS of webpages to parse
     :type urls: list
+    :param timeout: timeout (in seconds) for retrieving remote content
+    :type timeout: int
+    :param cache: shared cache for found image URLs, or None to always parse the webpages
+    :type cache: UrlCache
+    :param breaker: shared circuit breaker for failing dashboard hosts
+    :type breaker: CircuitBreaker
     :returns a list of URLs to images to retrieve
     :rtype: list
     """
@@ -197,21 +951,20 @@ def parseWebpage(logger, urls, timeout):
             anchor = None
         logger.debug("baseurl = %s" % baseUrl)
         logger.debug("anchor  = %s" % anchor)
-        try:
-            page = urllib2.urlopen(baseUrl, None, timeout=timeout).read()
-        except Exception as inst:
-            page = None
-            logger.warning("could not retrieve URL %s: %s" % (baseUrl, repr(inst)))
-        soup = BeautifulSoup(page)
-        if page:
-            if anchor is None:
-                link = soup.find('html').img['src']
-                logger.debug("no anchor found, link is %s" % link)
-            else:
-                link = soup.find('a', {"name": anchor}).img['src']
-                logger.debug("anchor found, link is %s" % link)
-        else:
+        cached = cache and cache.get(fullUrl)
+        if cached:
+            link = cached[1]
+        elif breaker and not breaker.allow(baseUrl):
             link = None
+        else:
+            try:
+                link = findImage(logger, baseUrl, anchor, timeout, breaker)
+                logger.debug("link is %s" % link)
+                if link and cache:
+                    cache.put(fullUrl, 'text/uri-list', link)
+            except Exception as inst:
+                link = None
+                logger.warning("could not retrieve URL %s: %s" % (baseUrl, repr(inst)))
 
         if link:
             returnList.append(link)
@@ -219,6 +972,42 @@ def parseWebpage(logger, urls, timeout):
     return returnList
 
 
+def getFqdn(cacheDirectory=None):
+    """return the fully qualified name of this host
+
+    socket.getfqdn() can take a DNS lookup, so the name is looked up only once per process, and when a cacheDirectory is
+    given also remembered there for FQDNTTL seconds for the next processes.
+
+    :param cacheDirectory: directory to remember the name in between processes
+    :type cacheDirectory: string
+    :returns: fully qualified name of this host
+    :rtype: string
+    """
+    if fqdn:
+        return fqdn[0]
+    if cacheDirectory:
+        path = os.path.join(cacheDirectory, '.fqdn')
+        try:
+            if os.stat(path).st_mtime + FQDNTTL > time.time():
+                with open(path) as fp:
+                    name = fp.read().strip()
+                if name:
+                    fqdn.append(name)
+                    return name
+        except (IOError, OSError):
+            pass
+    fqdn.append(socket.getfqdn())
+    if cacheDirectory:
+        try:
+            fd, tmpPath = tempfile.mkstemp(dir=cacheDirectory, prefix='.tmp')
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(fqdn[0])
+            os.rename(tmpPath, path)
+        except (IOError, OSError):
+            pass
+    return fqdn[0]
+
+
 def getMultipleEnvVars(startswith=''):
     """return a dict of environment variables starting with a string
 
@@ -253,7 +1042,7 @@ def mailTextBody(nagiosMappings):
     :returns: string for textbody of mail
     :rtype: string
     """
-    body = "***** [%s] Nagios *****\n\n" % socket.getfqdn()
+    body = "***** [%s] Nagios *****\n\n" % getFqdn()
     for displayString, envVar in nagiosMappings.iteritems():
         body += "%s: %s\n" % (displayString, getSingleEnvVar(envVar))
     body += "\nAdditional Info:\n\n%s\n" % getSingleEnvVar('NAGIOS_SERVICEOUTPUT')
@@ -274,13 +1063,13 @@ def mailHtmlBody(logger, graphUrls, companyBgColor, companyFgcolor, companyName,
     """
     body = '<html><body><table width="100%" border="0" cellspacing="0">\n'
     body += '<tr><td bgcolor="%s">\n' % companyBgColor
-    body += '  <img src="cid:%s.png@%s" align="left">\n' % (getSingleEnvVar('NAGIOS_SERVICESTATE'), socket.getfqdn())
+    body += '  <img src="cid:%s.png@%s" align="left">\n' % (getSingleEnvVar('NAGIOS_SERVICESTATE'), getFqdn())
     body += '</td>'
     body += '<td bgcolor="%s" align="right">\n' % companyBgColor
     body += '<font color="%s"><b>%s&nbsp;</b></font>' % (companyFgcolor, companyName)
     body += '</td></tr>\n'
     body += '<tr>\n'
-    body += '<td colspan="2" align="center">**** [%s] Nagios</td>\n' % socket.getfqdn()
+    body += '<td colspan="2" align="center">**** [%s] Nagios</td>\n' % getFqdn()
     body += '</tr>\n'
     for displayString, envVar in nagiosMappings.iteritems():
         displayVar = getSingleEnvVar(envVar)
@@ -336,7 +1125,7 @@ def mailHeaders(logger, replyto):
     """
     msgid = getSingleEnvVar('NAGIOS_SERVICEEVENTID')
     refid = getSingleEnvVar('NAGIOS_LASTSERVICEEVENTID')
-    hostname = socket.getfqdn()
+    hostname = getFqdn()
     headers = {'X-nagiosserver': hostname,
                'reply-to': replyto}
     if id and refid:
@@ -347,6 +1136,588 @@ def mailHeaders(logger, replyto):
     return headers
 
 
+def digestSubject(logger, envs, prefix=None):
+    """create the subject line for a digest mail, and add the optional prefix
+
+    :param envs: environment variables of the notifications in the digest
+    :type envs: list
+    :param prefix: prefix to add to start of subjectline
+    :type prefix: string
+    :returns a string to use as subject for the mail
+    :rtype: string
+    """
+    hosts = set(env.get('NAGIOS_HOSTDISPLAYNAME', '') for env in envs)
+    subject = "Nagios digest: %d notifications for %d hosts **" % (len(envs), len(hosts))
+    if prefix:
+        subject = "%s %s" % (prefix, subject)
+    logger.debug("mailsubject: %s" % subject)
+    return subject
+
+
+def buildDigestEmail(logger, envs, subject, options, cache=None, breaker=None):
+    """Builds a digest mail for a number of notifications, grouped by host and state, with text and html alternative.
+
+    Graphs are attached as long as they fit in options.digestGraphBudget bytes, shrunk when needed, the others are
+    linked. Once a graph does not fit anymore, the budget is considered spent: the remaining graphs and dashboards are
+    linked without retrieving them. The digest references the threading headers of all notifications in it, so
+    mailreaders show it with those threads.
+
+    :param logger: logobject
+    :type logger: logging.getlogger
+    :param envs: environment variables of the notifications, oldest first
+    :type envs: list
+    :param subject: Email subject line
+    :type subject: string
+    :param options: parsed options
+    :type options: argparse.Namespace
+    :param cache: shared cache for retrieved images and webpages
+    :type cache: UrlCache
+    :param breaker: shared circuit breaker for failing graph hosts
+    :type breaker: CircuitBreaker
+    :returns: the rendered mail, without recipient headers
+    :rtype: string
+    """
+    from email.mime.image import MIMEImage
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
+    hostname = getFqdn()
+    groups = {}
+    references = []
+    for env in envs:
+        groups.setdefault((env.get('NAGIOS_HOSTDISPLAYNAME', ''), env.get('NAGIOS_SERVICESTATE', '')), []).append(env)
+        setNagiosEnv(env)
+        threadHeaders = mailHeaders(logger, '')
+        for header in ('References', 'Message-ID'):
+            if header in threadHeaders and threadHeaders[header] not in references:
+                references.append(threadHeaders[header])
+
+    images = []
+    budget = int(options.digestGraphBudget)
+    spent = budget <= 0
+    textBody = "***** [%s] Nagios digest *****\n\n" % hostname
+    htmlBody = '<html><body><table width="100%" border="0" cellspacing="0">\n'
+    htmlBody += '<tr><td bgcolor="%s" colspan="2" align="right">\n' % options.bgcolor
+    htmlBody += '<font color="%s"><b>%s&nbsp;</b></font>' % (options.fgcolor, options.name)
+    htmlBody += '</td></tr>\n'
+    htmlBody += '<tr><td colspan="2" align="center">**** [%s] Nagios digest</td></tr>\n' % hostname
+    num = 0
+    for host, state in sorted(groups):
+        textBody += "%s: %s\n" % (host, state)
+        htmlBody += '<tr><td colspan="2"><b>%s</b>: %s</td></tr>\n' % (host, state)
+        for env in groups[(host, state)]:
+            line = (env.get('NAGIOS_SERVICEDISPLAYNAME', ''), env.get('NAGIOS_NOTIFICATIONTYPE', ''),
+                    env.get('NAGIOS_LONGDATETIME', ''), env.get('NAGIOS_SERVICEOUTPUT', ''))
+            textBody += "  %s (%s, %s): %s\n" % line
+            htmlBody += '<tr><td>%s</td><td align="left">(%s, %s) %s</td></tr>\n' % line
+
+            setNagiosEnv(env)
+            graphUrls = getMultipleEnvVars('NAGIOS__SERVICEGRAPHURL').values()
+            dashUrls = getMultipleEnvVars('NAGIOS__SERVICEDASHURL').values()
+            if spent:
+                # a digest of a storm holds many notifications, do not retrieve graphs that cannot be attached anyway
+                graphUrls += dashUrls
+            else:
+                graphUrls += parseWebpage(logger, dashUrls, options.timeout, cache, breaker)
+            for graph_url in graphUrls:
+                graph = None
+                if not spent:
+                    graph = fetchGraph(logger, graph_url, options.timeout, cache, breaker)
+                    if graph is None:
+                        continue
+                    graph = shrinkGraph(logger, graph[0], graph[1], budget)
+                if graph is None:
+                    logger.debug("graph %s does not fit in digest, linking it" % graph_url)
+                    htmlBody += '<tr><td colspan="2" align="left"><a href="%s">Graph</a></td></tr>\n' % \
+                                graph_url.replace('__AMPERSAND__', '&')
+                    spent = True
+                    continue
+                imgtype, content = graph
+                budget -= encodedSize(len(content))
+                imgpart = MIMEImage(content, _subtype=imgtype)
+                imgpart.add_header('Content-Disposition', 'attachment', filename="graph%s" % num)
+                imgpart.add_header('Content-ID', '<graph%s>' % num)
+                images.append(imgpart)
+                htmlBody += '<tr><td colspan="2" align="left"><img src="cid:graph%s"></td></tr>\n' % num
+                num += 1
+        textBody += "\n"
+    htmlBody += '</table></body></html>\n'
+
+    msg = MIMEMultipart()
+    msg['From'] = options.mailsender
+    msg['Subject'] = subject
+    msg['X-nagiosserver'] = hostname
+    # a worker can send digests to several contacts within a second, the random part keeps their ids apart
+    msg['Message-ID'] = "<nagiosdigest-%d.%d.%s@%s>" % (time.time(), os.getpid(), os.urandom(4).encode('hex'), hostname)
+    if references:
+        msg['References'] = ' '.join(references)
+    msg.preamble = 'This is a multi-part message in MIME format.'
+    msgAlternative = MIMEMultipart('alternative')
+    msgAlternative.attach(MIMEText(textBody, 'plain'))
+    # html part and images need to be in a 'related' Mime container
+    related = MIMEMultipart('related')
+    related.attach(MIMEText(htmlBody, 'html'))
+    for imgpart in images:
+        related.attach(imgpart)
+    msgAlternative.attach(related)
+    msg.attach(msgAlternative)
+    return msg.as_string()
+
+
+def smtpConnect(logger, options):
+    """open a connection to the mailserver
+
+    :param logger: logobject
+    :type logger: logging.getlogger()
+    :param options: parsed options
+    :type options: argparse.Namespace
+    :returns: the connection, or None when the mailserver could not be reached
+    :rtype: smtplib.SMTP
+    """
+    try:
+        # without a timeout, a hanging mailserver blocks a delivery worker forever
+        import smtplib
+        smtp = smtplib.SMTP(options.smtpHost, int(options.smtpPort), timeout=float(options.smtpTimeout))
+        logger.debug("connected to mailserver %s:%s" % (options.smtpHost, options.smtpPort))
+        return smtp
+    except Exception as inst:
+        logger.error("could not connect to mailserver %s:%s: %s" % (options.smtpHost, options.smtpPort, inst))
+        return None
+
+
+class Spool(object):
+    """A directory with notifications waiting for the delivery daemon, laid out like a maildir:
+
+    tmp/    : notifications that are being written
+    new/    : notifications ready for delivery
+    cur/    : notifications claimed by a delivery worker
+    failed/ : notifications that could not be delivered after all retries
+
+    Every notification is a single file holding the NAGIOS_* environment of the notification as 'NAME=value' entries
+    separated by NUL characters, just like /proc/<pid>/environ. Files only move between these directories with
+    rename(), so a notification is never lost or delivered twice when a process dies halfway. The filename starts with
+    the time the notification may be delivered, which is used to delay retries.
+    """
+
+    def __init__(self, logger, directory):
+        """
+        :param logger: logobject
+        :type logger: logging.getlogger()
+        :param directory: spool directory, created when it does not exist
+        :type directory: string
+        """
+        self.logger = logger
+        self.directory = directory
+        for subdir in ('tmp', 'new', 'cur', 'failed'):
+            try:
+                os.makedirs(os.path.join(directory, subdir), 0700)
+            except OSError as inst:
+                if inst.errno != errno.EEXIST:
+                    raise
+
+    def enqueue(self, env, notBefore=None):
+        """add a notification to the spool
+
+        :param env: environment variables of the notification
+        :type env: dict
+        :param notBefore: do not deliver before this time (in seconds since the epoch), default is right away
+        :type notBefore: float
+        :returns: name of the spoolfile
+        :rtype: string
+        """
+        name = "%d.%d.%s" % (notBefore or time.time(), os.getpid(), os.urandom(4).encode('hex'))
+        tmpPath = os.path.join(self.directory, 'tmp', name)
+        with open(tmpPath, 'wb') as fp:
+            fp.write(''.join("%s=%s\0" % (k, v) for k, v in env.iteritems()))
+            # on disk before it shows up in new/, so that a power loss cannot leave an empty notification there
+            fp.flush()
+            os.fsync(fp.fileno())
+        newDirectory = os.path.join(self.directory, 'new')
+        os.rename(tmpPath, os.path.join(newDirectory, name))
+        # and the rename itself on disk, so that the notification is not lost once Nagios considers it sent
+        dirfd = os.open(newDirectory, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        self.logger.debug("spooled notification as %s" % name)
+        return name
+
+    def ready(self):
+        """list the notifications that are due for delivery, oldest first
+
+        :returns: names of spoolfiles
+        :rtype: list
+        """
+        now = time.time()
+        names = []
+        for name in sorted(os.listdir(os.path.join(self.directory, 'new'))):
+            try:
+                if int(name.split('.')[0]) <= now:
+                    names.append(name)
+            except ValueError:
+                self.logger.warning("ignoring unknown file %s in spool" % name)
+        return names
+
+    def claim(self, name):
+        """claim a notification for delivery by moving it to cur/
+
+        :param name: name of the spoolfile
+        :type name: string
+        :returns: path of the claimed spoolfile, or None when someone else claimed it first
+        :rtype: string
+        """
+        path = os.path.join(self.directory, 'cur', name)
+        try:
+            os.rename(os.path.join(self.directory, 'new', name), path)
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def load(self, path):
+        """read a claimed notification
+
+        :param path: path of the spoolfile
+        :type path: string
+        :returns: environment variables of the notification
+        :rtype: dict
+        """
+        with open(path, 'rb') as fp:
+            return dict(entry.split('=', 1) for entry in fp.read().split('\0') if entry)
+
+    def done(self, path):
+        """remove a delivered notification from the spool
+
+        :param path: path of the spoolfile
+        :type path: string
+        :returns: None
+        """
+        os.remove(path)
+
+    def retry(self, path, retries, retryDelay):
+        """put a notification that could not be delivered back in the spool, or move it to failed/ when it has been
+        tried too often. The delay between retries grows with every attempt.
+
+        :param path: path of the spoolfile
+        :type path: string
+        :param retries: number of times delivery is retried
+        :type retries: int
+        :param retryDelay: seconds to wait before the first retry
+        :type retryDelay: int
+        :returns: None
+        """
+        env = self.load(path)
+        attempts = int(env.get('NAGIOSMAILER_ATTEMPTS', 0)) + 1
+        if attempts > retries:
+            self.logger.error("giving up on notification %s after %d attempts" % (path, attempts))
+            os.rename(path, os.path.join(self.directory, 'failed', os.path.basename(path)))
+            return
+        env['NAGIOSMAILER_ATTEMPTS'] = str(attempts)
+        name = self.enqueue(env, time.time() + retryDelay * attempts)
+        os.remove(path)
+        self.logger.warning("notification %s will be retried as %s" % (path, name))
+
+    def recover(self, maxAge=0, keep=()):
+        """move claimed notifications that have not been finished within maxAge seconds back to new/
+
+        :param maxAge: only recover notifications claimed longer ago than this
+        :type maxAge: int
+        :param keep: paths of claimed notifications that are held on purpose and should not be recovered
+        :type keep: set
+        :returns: paths of the recovered notifications (in cur/)
+        :rtype: list
+        """
+        recovered = []
+        oldest = time.time() - maxAge
+        curDirectory = os.path.join(self.directory, 'cur')
+        for name in os.listdir(curDirectory):
+            path = os.path.join(curDirectory, name)
+            if path in keep:
+                continue
+            try:
+                if os.stat(path).st_mtime <= oldest:
+                    os.rename(path, os.path.join(self.directory, 'new', name))
+                    recovered.append(path)
+                    self.logger.warning("recovered unfinished notification %s" % name)
+            except OSError:
+                pass
+        return recovered
+
+
+def setNagiosEnv(env):
+    """replace the Nagios environment variables of this process by the ones of a spooled notification
+
+    :param env: environment variables of the notification
+    :type env: dict
+    :returns: None
+    """
+    for key in [key for key in os.environ if key.startswith('NAGIOS')]:
+        del os.environ[key]
+    os.environ.update(env)
+
+
+# state of a delivery worker process, filled by initWorker()
+worker = {}
+
+
+def initWorker(options):
+    """set up a delivery worker process of the daemon
+
+    :param options: parsed options
+    :type options: argparse.Namespace
+    :returns: None
+    """
+    # the daemon decides when to stop, and waits for the workers to finish their notifications
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    logger = logging.getLogger('main')
+    worker['logger'] = logger
+    worker['options'] = options
+    worker['spool'] = Spool(logger, options.spoolDirectory)
+    worker['cache'] = getCache(logger, options)
+    worker['breaker'] = getBreaker(logger, options)
+    worker['smtp'] = None
+
+
+def workerSmtp():
+    """return the persistent mailserver connection of this worker, reconnecting when it was lost
+
+    :returns: the connection, or None when the mailserver could not be reached
+    :rtype: smtplib.SMTP
+    """
+    if worker['smtp'] is not None:
+        try:
+            worker['smtp'].noop()
+            return worker['smtp']
+        except Exception as inst:
+            worker['logger'].debug("lost connection to mailserver: %s" % inst)
+            worker['smtp'] = None
+    worker['smtp'] = smtpConnect(worker['logger'], worker['options'])
+    return worker['smtp']
+
+
+def deliverSpooled(paths):
+    """deliver claimed notifications about the same event from within a worker process, as a single mail
+
+    :param paths: paths of the claimed spoolfiles
+    :type paths: list
+    :returns: paths of the spoolfiles
+    :rtype: list
+    """
+    logger = worker['logger']
+    options = worker['options']
+    try:
+        envs = [worker['spool'].load(path) for path in paths]
+        setNagiosEnv(envs[0])
+        receivers = [env['NAGIOS_CONTACTEMAIL'] for env in envs if env.get('NAGIOS_CONTACTEMAIL')]
+        smtp = workerSmtp()
+        if smtp is not None and notify(logger, options, worker['cache'], smtp, receivers, worker['breaker']):
+            for path in paths:
+                worker['spool'].done(path)
+            return paths
+        # start with a fresh connection next time
+        worker['smtp'] = None
+    except Exception as inst:
+        logger.error("delivering notifications %s failed: %s" % (paths, repr(inst)))
+    for path in paths:
+        try:
+            worker['spool'].retry(path, int(options.retries), int(options.retryDelay))
+        except Exception as inst:
+            logger.error("could not reschedule notification %s: %s" % (path, repr(inst)))
+    return paths
+
+
+def deliverDigest(receiver, paths):
+    """deliver claimed notifications for a single contact from within a worker process, as a digest mail
+
+    :param receiver: email address of the contact
+    :type receiver: string
+    :param paths: paths of the claimed spoolfiles
+    :type paths: list
+    :returns: paths of the spoolfiles
+    :rtype: list
+    """
+    logger = worker['logger']
+    options = worker['options']
+    try:
+        envs = [worker['spool'].load(path) for path in paths]
+        subject = digestSubject(logger, envs, options.subjectPrefix)
+        message = buildDigestEmail(logger, envs, subject, options, worker['cache'], worker['breaker'])
+        smtp = workerSmtp()
+        if smtp is not None and sendGraphEmail(logger, message, subject, options.mailsender, [receiver], smtp):
+            for path in paths:
+                worker['spool'].done(path)
+            return paths
+        # start with a fresh connection next time
+        worker['smtp'] = None
+    except Exception as inst:
+        logger.error("delivering digest %s failed: %s" % (paths, repr(inst)))
+    for path in paths:
+        try:
+            worker['spool'].retry(path, int(options.retries), int(options.retryDelay))
+        except Exception as inst:
+            logger.error("could not reschedule notification %s: %s" % (path, repr(inst)))
+    return paths
+
+
+class Digester(object):
+    """Decides per contact whether a notification is sent right away or collected in a digest mail.
+
+    The first threshold notifications for a contact within window seconds are sent right away. After that, the next
+    notifications are held in a digest that is sent when its window has passed, so a storm results in a few mails per
+    contact instead of hundreds.
+    """
+
+    def __init__(self, window, threshold):
+        """
+        :param window: seconds to collect notifications in a digest, 0 disables digests
+        :type window: int
+        :param threshold: number of notifications within window that are sent right away
+        :type threshold: int
+        """
+        self.window = window
+        self.threshold = threshold
+        # contact -> times of recent mails
+        self.sent = {}
+        # contact -> (time the digest is due, paths of the notifications in it)
+        self.pending = {}
+
+    def add(self, receiver, path, now=None):
+        """decide what to do with a notification
+
+        :param receiver: email address of the contact
+        :type receiver: string
+        :param path: path of the claimed spoolfile
+        :type path: string
+        :returns: True when the notification should be sent right away, False when it was added to a digest
+        :rtype: bool
+        """
+        if not self.window or not receiver:
+            return True
+        now = now or time.time()
+        if receiver in self.pending:
+            self.pending[receiver][1].append(path)
+            return False
+        sent = [t for t in self.sent.get(receiver, []) if t > now - self.window]
+        if len(sent) < self.threshold:
+            self.sent[receiver] = sent + [now]
+            return True
+        self.sent[receiver] = sent
+        self.pending[receiver] = (now + self.window, [path])
+        return False
+
+    def held(self):
+        """
+        :returns: paths of all notifications held in digests
+        :rtype: set
+        """
+        return set(path for due, paths in self.pending.itervalues() for path in paths)
+
+    def due(self, flush=False, now=None):
+        """take the digests that should be sent now
+
+        :param flush: take all digests, also the ones whose window has not passed yet
+        :type flush: bool
+        :returns: a list of tuples (receiver, paths)
+        :rtype: list
+        """
+        now = now or time.time()
+        digests = []
+        for receiver in self.pending.keys():
+            if flush or self.pending[receiver][0] <= now:
+                digests.append((receiver, self.pending.pop(receiver)[1]))
+                self.sent.setdefault(receiver, []).append(now)
+        return digests
+
+
+def spoolBatches(spool, options, renderKeys):
+    """group the notifications that are due for delivery into batches that are sent as a single mail
+
+    With batchRecipients, all contacts notified about the same event get one mail in one SMTP transaction, otherwise
+    every notification is a batch of its own. Spoolfiles never change once they are in new/, so their render keys are
+    remembered in renderKeys and every spoolfile is read only once, no matter how long it waits in the spool.
+
+    :param spool: the spool
+    :type spool: Spool
+    :param options: parsed options
+    :type options: argparse.Namespace
+    :param renderKeys: render keys of spoolfiles by name, kept between calls
+    :type renderKeys: dict
+    :returns: lists of names of spoolfiles, oldest first
+    :rtype: list
+    """
+    names = spool.ready()
+    if options.batchRecipients != 'yes':
+        return [[name] for name in names]
+    for name in set(renderKeys) - set(names):
+        del renderKeys[name]
+    batches = {}
+    order = []
+    for name in names:
+        if name not in renderKeys:
+            try:
+                renderKeys[name] = renderKey(spool.load(os.path.join(spool.directory, 'new', name)), options)
+            except (IOError, OSError):
+                continue
+        key = renderKeys[name]
+        if key not in batches:
+            batches[key] = []
+            order.append(key)
+        batches[key].append(name)
+    return [batches[key] for key in order]
+
+
+def runDaemon(logger, options):
+    """deliver the notifications in the spool directory with a pool of worker processes until SIGTERM or SIGINT
+
+    :param logger: logobject
+    :type logger: logging.getlogger()
+    :param options: parsed options
+    :type options: argparse.Namespace
+    :returns: None
+    """
+    spool = Spool(logger, options.spoolDirectory)
+    spool.recover()
+    workers = int(options.workers)
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, initWorker, (options,))
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+    logger.info("delivery daemon started with %d workers on spool %s" % (workers, options.spoolDirectory))
+
+    digester = Digester(int(options.digestWindow), int(options.digestThreshold))
+    claimed = {}
+    renderKeys = {}
+    while not stopping:
+        for paths in claimed.keys():
+            if claimed[paths].ready():
+                del claimed[paths]
+        recovered = spool.recover(STALEAFTER, digester.held())
+        for paths in claimed.keys():
+            if set(paths) & set(recovered):
+                del claimed[paths]
+        # keep the queue short, so that notifications stay in the spool when the daemon is killed
+        for names in spoolBatches(spool, options, renderKeys)[:max(0, 2 * workers - len(claimed))]:
+            paths = tuple(path for path in map(spool.claim, names) if path)
+            if digester.window:
+                paths = tuple(path for path in paths
+                              if digester.add(spool.load(path).get('NAGIOS_CONTACTEMAIL'), path))
+            if paths:
+                claimed[paths] = pool.apply_async(deliverSpooled, (paths,))
+        for receiver, paths in digester.due():
+            claimed[tuple(paths)] = pool.apply_async(deliverDigest, (receiver, paths))
+        time.sleep(POLLINTERVAL)
+
+    for receiver, paths in digester.due(flush=True):
+        claimed[tuple(paths)] = pool.apply_async(deliverDigest, (receiver, paths))
+    logger.info("delivery daemon stopping, waiting for %d notifications in progress" % len(claimed))
+    pool.close()
+    pool.join()
+
+
 def do_options(configDefaults):
     """parse commandline options and get defaults from configfile
 
@@ -354,9 +1725,14 @@ def do_options(configDefaults):
     :rtype: argparse.Namespace
     """
     description = "an extended mailer for nagios than can add images to servicenotification mails"
+    import argparse
     parser = argparse.ArgumentParser(description=description)
     for key in configDefaults.keys():
-        parser.add_argument("-%s" % key[0], "--%s" % key,
+        # only the original options have a one letter alias, newer ones would clash with those
+        flags = ["--%s" % key]
+        if configDefaults[key].get('short', True):
+            flags.insert(0, "-%s" % key[0])
+        parser.add_argument(*flags,
                             help="%s (default: '%s')" % (configDefaults[key]['help'], configDefaults[key]['default']),
                             choices=configDefaults[key]['choices'])
     options = parser.parse_args()
@@ -410,6 +1786,7 @@ def setLogger(options, logBacklog):
 
     :param options: parsed options
     """
+    import logging.handlers
     logger = logging.getLogger('main')
     loglevel = logging.getLevelName(options.debuglevel)
     logger.setLevel(loglevel)
@@ -437,15 +1814,12 @@ def setLogger(options, logBacklog):
     return logger
 
 
-def main():
-    nagiosDict = {'Notification Type': 'NAGIOS_NOTIFICATIONTYPE',
-                      'Service': 'NAGIOS_SERVICEDISPLAYNAME',
-                      'Host': 'NAGIOS_HOSTDISPLAYNAME',
-                      'Address': 'NAGIOS_HOSTADDRESS',
-                      'State': 'NAGIOS_SERVICESTATE',
-                      'Docs': 'NAGIOS_SERVICENOTESURL',
-                      'Date/Time': 'NAGIOS_LONGDATETIME'}
+def setup():
+    """parse commandline options and configfile and set up logging
 
+    :returns: options and logger
+    :rtype: argparse.Namespace, logging.getlogger()
+    """
     configDefaults = {'imgDirectory': {'default': '/etc/nagiosmailer/',
                                        'help': 'directory containing images OK.png, WARNING.png CRITICAL.png UNKNOWN.png',
                                        'choices': None},
@@ -464,18 +1838,97 @@ def main():
                       'debuglevel': {'default': 'INFO',
                                      'help': 'loglevel',
                                      'choices': ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG']},
-                      'mailsender': {'default': 'nagios@%s' % socket.getfqdn(),
-                                      'help': 'From-address for mail',
+                      'mailsender': {'default': None,
+                                      'help': 'From-address for mail, nagios@<fqdn of this host> when not set',
                                       'choices': None},
                       'timeout': {'default': 1,
                                   'help': 'timeout (in seconds) for retrieving remote data',
                                   'choices': None},
-                      'configfile': {'default': '/etc/nagiosmailer/nagiosmailer.conf',
+                      'configfile': {'default': CONFIGFILE,
                                      'help': 'configfile to put options in',
                                      'choices': None},
                       'subjectPrefix': {'default': '',
                                         'help': 'prefix for mail subject',
-                                        'choices': None}}
+                                        'choices': None},
+                      'cacheDirectory': {'default': '/var/cache/nagiosmailer',
+                                         'help': 'directory for the graph cache shared between processes',
+                                         'choices': None,
+                                         'short': False},
+                      'cacheTtl': {'default': 60,
+                                   'help': 'seconds a cached graph or webpage stays valid, 0 disables caching',
+                                   'choices': None,
+                                   'short': False},
+                      'cacheMaxSize': {'default': 20000000,
+                                       'help': 'maximum size (in bytes) of the graph cache',
+                                       'choices': None,
+                                       'short': False},
+                      'mode': {'default': 'direct',
+                               'help': 'direct: send the mail right away, enqueue: put the notification in the spool '
+                                       'for the delivery daemon, daemon: run the delivery daemon',
+                               'choices': ['direct', 'enqueue', 'daemon'],
+                               'short': False},
+                      'spoolDirectory': {'default': SPOOLDIRECTORY,
+                                         'help': 'spool directory for notifications waiting for the delivery daemon',
+                                         'choices': None,
+                                         'short': False},
+                      'workers': {'default': 4,
+                                  'help': 'number of worker processes of the delivery daemon',
+                                  'choices': None,
+                                  'short': False},
+                      'retries': {'default': 5,
+                                  'help': 'number of times the delivery daemon retries a failed notification',
+                                  'choices': None,
+                                  'short': False},
+                      'retryDelay': {'default': 60,
+                                     'help': 'seconds before the first retry, later retries wait longer',
+                                     'choices': None,
+                                     'short': False},
+                      'smtpHost': {'default': 'localhost',
+                                   'help': 'mailserver to send mail to',
+                                   'choices': None,
+                                   'short': False},
+                      'smtpPort': {'default': 25,
+                                   'help': 'port of the mailserver',
+                                   'choices': None,
+                                   'short': False},
+                      'smtpTimeout': {'default': 30,
+                                      'help': 'timeout (in seconds) for every command sent to the mailserver',
+                                      'choices': None,
+                                      'short': False},
+                      'batchRecipients': {'default': 'no',
+                                          'help': 'let the delivery daemon send one mail to all contacts notified '
+                                                  'about the same event',
+                                          'choices': ['yes', 'no'],
+                                          'short': False},
+                      'digestWindow': {'default': 0,
+                                       'help': 'seconds the delivery daemon collects notifications for a contact in a '
+                                               'digest mail, 0 disables digests',
+                                       'choices': None,
+                                       'short': False},
+                      'digestThreshold': {'default': 5,
+                                          'help': 'notifications for a contact within digestWindow that are sent '
+                                                  'right away, before switching to digests',
+                                          'choices': None,
+                                          'short': False},
+                      'digestGraphBudget': {'default': 2000000,
+                                            'help': 'maximum size (in bytes) of the graphs attached to a digest mail, '
+                                                    'base64 encoding included',
+                                            'choices': None,
+                                            'short': False},
+                      'breakerThreshold': {'default': 3,
+                                           'help': 'consecutive failures after which a graph host is skipped, 0 never '
+                                                   'skips',
+                                           'choices': None,
+                                           'short': False},
+                      'breakerCooldown': {'default': 60,
+                                          'help': 'seconds to skip a failing graph host before trying it again',
+                                          'choices': None,
+                                          'short': False},
+                      'graphBudget': {'default': 3000000,
+                                      'help': 'maximum size (in bytes) of the graphs attached to a mail, base64 '
+                                              'encoding included. Larger graphs are shrunk or linked, 0 for no maximum',
+                                      'choices': None,
+                                      'short': False}}
 
     # remember things to log before we know where to log
     logBacklog = []
@@ -488,46 +1941,201 @@ def main():
 
     for key in configDefaults.keys():
         options.__dict__[key] = options.__dict__.get(key) or config.get(key) or configDefaults[key]['default']
+    # values from the commandline or configfile are strings, but sockets need a number
+    options.timeout = float(options.timeout)
 
     logger = setLogger(options, logBacklog)
 
+    # look up the name of this host once, later calls to getFqdn() get it from memory
+    hostname = getFqdn(options.cacheDirectory)
+    if not options.mailsender:
+        options.mailsender = 'nagios@%s' % hostname
+
     for option in options.__dict__:
         logger.debug("option %s is '%s'" % (option, options.__dict__[option]))
 
+    return options, logger
 
+
+def renderMail(logger, options, subject, receivers, cache=None, breaker=None):
+    """compose the mail for the notification in the Nagios environment variables of this process
+
+    :param logger: logobject
+    :type logger: logging.getlogger()
+    :param options: parsed options
+    :type options: argparse.Namespace
+    :param subject: Email subject line
+    :type subject: string
+    :param receivers: email addresses the mail is sent to
+    :type receivers: list
+    :param cache: shared cache for retrieved images and webpages
+    :type cache: UrlCache
+    :param breaker: shared circuit breaker for failing graph hosts
+    :type breaker: CircuitBreaker
+    :returns: the rendered mail, without recipient headers
+    :rtype: string
+    """
     directUrls = getMultipleEnvVars('NAGIOS__SERVICEGRAPHURL').values()
     logger.debug("found direct URLS:")
     for url in directUrls:
         logger.debug("  - %s" % url)
 
-    inDirectUrls = parseWebpage(logger, getMultipleEnvVars('NAGIOS__SERVICEDASHURL').values(), options.timeout)
+    with timedPhase('parseWebpage'):
+        inDirectUrls = parseWebpage(logger, getMultipleEnvVars('NAGIOS__SERVICEDASHURL').values(),
+                                    options.timeout, cache, breaker)
     logger.debug("found indirect URLS:")
     for url in inDirectUrls:
         logger.debug("  - %s" % url)
 
     graphUrls = directUrls + inDirectUrls
-    textBody = mailTextBody(nagiosDict)
-    htmlBody = mailHtmlBody(logger, graphUrls, options.bgcolor, options.fgcolor, options.name, nagiosDict)
-    subject = mailSubject(logger, options.subjectPrefix)
-    receiver = getSingleEnvVar('NAGIOS_CONTACTEMAIL')
-    replyto = receiver
-    logger.debug("mailreceiver: %s" % receiver)
-
-    headers = mailHeaders(logger, replyto)
-
-    if receiver:
-        sendGraphEmail(logger,
-                       graphUrls,
-                       subject,
-                       options.mailsender,
-                       receiver,
-                       textBody,
-                       htmlBody,
-                       headers,
-                       options.imgDirectory,
-                       options.timeout)
-    else:
+    textBody = mailTextBody(NAGIOSDICT)
+    htmlBody = mailHtmlBody(logger, graphUrls, options.bgcolor, options.fgcolor, options.name, NAGIOSDICT)
+    headers = mailHeaders(logger, ', '.join(receivers))
+    return buildGraphEmail(logger,
+                           graphUrls,
+                           subject,
+                           options.mailsender,
+                           textBody,
+                           htmlBody,
+                           headers,
+                           options.imgDirectory,
+                           options.timeout,
+                           cache,
+                           breaker,
+                           int(options.graphBudget))
+
+
+def notify(logger, options, cache=None, smtp=None, receivers=None, breaker=None):
+    """compose and send the mail for the notification in the Nagios environment variables of this process
+
+    Nagios notifies every contact separately, but the mail is the same for all contacts notified about the same event.
+    So the rendered mail is kept in the cache and reused for the other contacts. Processes for contacts that are
+    notified at the same moment wait for the first one to render the mail, instead of all rendering it themselves.
+
+    :param logger: logobject
+    :type logger: logging.getlogger()
+    :param options: parsed options
+    :type options: argparse.Namespace
+    :param cache: shared cache for retrieved images and webpages and rendered mails
+    :type cache: UrlCache
+    :param smtp: open connection to send the mail over, or None to open a connection for this mail only
+    :type smtp: smtplib.SMTP
+    :param receivers: email addresses to send the mail to, default is the contact of the notification
+    :type receivers: list
+    :param breaker: shared circuit breaker for failing graph hosts
+    :type breaker: CircuitBreaker
+    :returns: False when the mail could not be handed over to the mailserver
+    :rtype: bool
+    """
+    for phase in MAILPHASES:
+        phaseTimes.pop(phase, None)
+    if receivers is None:
+        receivers = [receiver for receiver in [getSingleEnvVar('NAGIOS_CONTACTEMAIL')] if receiver]
+    logger.debug("mailreceivers: %s" % receivers)
+    if not receivers:
         logger.warning("no receiver found, not sending mail")
+        return True
+
+    with timedPhase('mime'):
+        subject = mailSubject(logger, options.subjectPrefix)
+        if cache is None:
+            message = renderMail(logger, options, subject, receivers, cache, breaker)
+        else:
+            key = renderKey(os.environ, options)
+            cached = cache.get(key)
+            if not cached:
+                with cache.lock(key):
+                    # another process may have rendered the mail while this one waited for the lock
+                    cached = cache.get(key)
+                    if not cached:
+                        message = renderMail(logger, options, subject, receivers, cache, breaker)
+                        cache.put(key, 'message/rfc822', message)
+            if cached:
+                logger.debug("reusing mail rendered for %s" % key)
+                message = cached[1]
+
+    with timedPhase('smtp'):
+        oneShot = smtp is None
+        if oneShot:
+            smtp = smtpConnect(logger, options)
+            if smtp is None:
+                return False
+        sent = sendGraphEmail(logger, message, subject, options.mailsender, receivers, smtp)
+        if oneShot:
+            try:
+                smtp.quit()
+            except Exception:
+                pass
+    logger.debug("seconds per phase: %s" % ', '.join("%s %.3f" % item for item in sorted(phaseTimes.items())))
+    return sent
+
+
+def quickOption(argv, name, short=None):
+    """look up a single commandline option without argparse. Only '--name value', '--name=value' and '-short value'
+    are recognised, anything else is left to do_options()
+
+    :param argv: commandline arguments
+    :type argv: list
+    :param name: long name of the option
+    :type name: string
+    :param short: one letter alias of the option
+    :type short: string
+    :returns: value of the option, or None when it is not given
+    :rtype: string
+    """
+    for num, arg in enumerate(argv):
+        if arg == '--' + name or (short and arg == '-' + short):
+            if num + 1 < len(argv):
+                return argv[num + 1]
+        elif arg.startswith('--%s=' % name):
+            return arg.split('=', 1)[1]
+    return None
+
+
+def quickEnqueue():
+    """spool the notification of this process when running with '--mode enqueue', without loading and setting up
+    everything that sending a mail needs. Nagios waits for every notification command, so this has to be quick.
+
+    :returns: True when the notification was spooled, False when not running in enqueue mode
+    :rtype: bool
+    :raises: IOError or OSError when the notification could not be spooled
+    """
+    argv = sys.argv[1:]
+    configfile = quickOption(argv, 'configfile', 'c') or CONFIGFILE
+    config, logBacklog = getConfig(configfile, {'mode': None, 'spoolDirectory': None}, [])
+    if (quickOption(argv, 'mode') or config.get('mode')) != 'enqueue':
+        return False
+    spoolDirectory = quickOption(argv, 'spoolDirectory') or config.get('spoolDirectory') or SPOOLDIRECTORY
+    Spool(logging.getLogger('main'), spoolDirectory).enqueue(getMultipleEnvVars('NAGIOS'))
+    return True
+
+
+def main():
+    spoolError = None
+    try:
+        if quickEnqueue():
+            return
+    except (IOError, OSError) as inst:
+        spoolError = inst
+
+    with timedPhase('env'):
+        options, logger = setup()
+
+    if options.mode == 'daemon':
+        runDaemon(logger, options)
+        return
+
+    if options.mode == 'enqueue' and spoolError is None:
+        # options that quickEnqueue() does not recognise, like abbreviations
+        try:
+            Spool(logger, options.spoolDirectory).enqueue(getMultipleEnvVars('NAGIOS'))
+            return
+        except (IOError, OSError) as inst:
+            spoolError = inst
+    if spoolError is not None:
+        logger.error("could not spool notification, sending it directly: %s" % spoolError)
+
+    notify(logger, options, getCache(logger, options), breaker=getBreaker(logger, options))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Regression tests for finding the graph on a dashboard page (ImageFinder and findImage). Pages are served by a local
+webserver, so they are read in READCHUNK chunks just like real dashboards.
+
+usage: python -m unittest discover -s tests
+"""
+
+import BaseHTTPServer
+import logging
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import nagiosmailer
+
+# served pages by path: (content-type, body)
+PAGES = {}
+
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        contentType, body = PAGES[self.path]
+        self.send_response(200)
+        self.send_header('content-type', contentType)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FindImageTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), PageHandler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.base = 'http://127.0.0.1:%d' % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def findImage(self, path, body, anchor=None, contentType='text/html'):
+        PAGES[path] = (contentType, body)
+        return nagiosmailer.findImage(logging.getLogger('test'), self.base + path, anchor, 1)
+
+    def test_first_image(self):
+        link = self.findImage('/first', '<html><body><p>graph</p><img src="/graph.png"><img src="/other.png">')
+        self.assertEqual(link, self.base + '/graph.png')
+        self.assertTrue(isinstance(link, str))
+
+    def test_uppercase_tags(self):
+        link = self.findImage('/upper', '<HTML><BODY><IMG SRC="first.png"><A NAME="g5"><IMG SRC="g5.png">', 'g5')
+        self.assertEqual(link, self.base + '/g5.png')
+
+    def test_anchor_split_over_chunks(self):
+        # the chunk boundary falls in the middle of name="g"
+        prefix = '<html><img src="/wrong.png"><p>'
+        prefix += 'x' * (nagiosmailer.READCHUNK - len(prefix) - len('</p><a na')) + '</p>'
+        body = prefix + '<a name="g"></a><img src="/right.png">'
+        self.assertEqual(body[nagiosmailer.READCHUNK - 5:nagiosmailer.READCHUNK + 5], '<a name="g')
+        self.assertEqual(self.findImage('/split', body, 'g'), self.base + '/right.png')
+
+    def test_base_href_before_anchor(self):
+        # the base is chunks before the anchor, so it has long been skipped when the anchor is found
+        filler = '<div><img src="/wrong.png"></div>\n' * (3 * nagiosmailer.READCHUNK / 30)
+        body = ('<html><head><base href="http://graphs.example.com/dash/"></head><body>' + filler +
+                '<a name="load"></a><img src="load.png"></body></html>')
+        self.assertEqual(self.findImage('/base', body, 'load'), 'http://graphs.example.com/dash/load.png')
+
+    def test_no_image(self):
+        self.assertEqual(self.findImage('/none', '<html><body><p>no graphs here</p></body></html>'), None)
+
+    def test_no_image_after_anchor(self):
+        self.assertEqual(self.findImage('/noanchor', '<html><img src="/a.png"><a name="g"></a></html>', 'g'), None)
+        self.assertEqual(self.findImage('/missing', '<html><img src="/a.png"></html>', 'g'), None)
+
+    def test_non_ascii_before_image(self):
+        body = '<html><p title="Gr\xc3\xb6\xc3\x9fe &amp; x">x</p><img src="/gr\xc3\xb6\xc3\x9fe.png?a=1&amp;b=2">'
+        expected = self.base + '/gr%C3%B6%C3%9Fe.png?a=1&b=2'
+        self.assertEqual(self.findImage('/utf8', body), expected)
+        self.assertEqual(self.findImage('/latin1', body.decode('utf-8').encode('latin-1'),
+                                        contentType='text/html; charset=iso-8859-1'), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()